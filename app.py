@@ -2,7 +2,17 @@ import streamlit as st
 import folium
 from streamlit_folium import st_folium
 import requests
+import numpy as np
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
+import bisect
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 st.set_page_config(
     page_title="Air Quality Monitor",
@@ -10,12 +20,18 @@ st.set_page_config(
     layout="wide"
 )
 
-try:
-    OPENWEATHER_API_KEY = st.secrets["OPENWEATHER_API_KEY"]
-except FileNotFoundError:
-    OPENWEATHER_API_KEY = os.environ.get("OPENWEATHER_API_KEY")
+@st.cache_resource
+def get_api_key():
+    """Resolves the OpenWeatherMap key once per process instead of reading secrets on every rerun."""
+    try:
+        return st.secrets["OPENWEATHER_API_KEY"]
+    except FileNotFoundError:
+        return os.environ.get("OPENWEATHER_API_KEY")
+
+OPENWEATHER_API_KEY = get_api_key()
 
 if not OPENWEATHER_API_KEY:
+    get_api_key.clear()
     st.error("OpenWeatherMap API key not found! Please configure it in .streamlit/secrets.toml")
     st.stop()
 
@@ -29,13 +45,12 @@ AIRNOW_AQI_GUIDE = [
     {"range": (301, 10000), "level": "Hazardous", "color": "#7e0023", "description": "Health warning of emergency conditions: everyone is more likely to be affected."}
 ]
 
+_AQI_HIGHS = [category["range"][1] for category in AIRNOW_AQI_GUIDE]
+
 def get_airnow_aqi_info(aqi_value):
     """Finds the corresponding AQI level, color, and description from the AirNow guide."""
-    for category in AIRNOW_AQI_GUIDE:
-        low, high = category["range"]
-        if low <= aqi_value <= high:
-            return category
-    return AIRNOW_AQI_GUIDE[-1]
+    i = bisect.bisect_left(_AQI_HIGHS, aqi_value)
+    return AIRNOW_AQI_GUIDE[min(i, len(AIRNOW_AQI_GUIDE) - 1)]
 
 BREAKPOINTS = {
     'o3_ppm': [(0.000,0.054,0,50),(0.055,0.070,51,100),(0.071,0.085,101,150),(0.086,0.105,151,200),(0.106,0.200,201,300),(0.201,0.404,301,400)],
@@ -46,125 +61,179 @@ BREAKPOINTS = {
     'no2_ppb': [(0,53,0,50),(54,100,51,100),(101,360,101,150),(361,649,151,200),(650,1249,201,300),(1250,1649,301,400)]
 }
 POLLUTANT_NAMES = {'o3_ppm':'Ozone (O₃)','pm2_5':'PM₂.₅','pm10':'PM₁₀','co_ppm':'CO','so2_ppb':'SO₂','no2_ppb':'NO₂'}
+POLLUTANT_KEYS = tuple(BREAKPOINTS)
+
+# Columns: bp_low, bp_hi, i_low, i_hi. BP_TABLE stacks every pollutant in POLLUTANT_KEYS order.
+BP_TABLE = np.array([BREAKPOINTS[k] for k in POLLUTANT_KEYS], dtype=np.float64)
+_BP_ROWS = np.arange(len(POLLUTANT_KEYS))
 
 def calculate_pollutant_aqi(pollutant_key, concentration):
     if concentration < 0: return 0
-    breakpoints = BREAKPOINTS.get(pollutant_key)
-    if not breakpoints: return 0
-    for bp_low,bp_hi,i_low,i_hi in breakpoints:
-        if bp_low <= concentration <= bp_hi:
-            if(bp_hi - bp_low) == 0: return i_low
-            aqi = ((i_hi - i_low) / (bp_hi - bp_low)) * (concentration - bp_low) + i_low
-            return round(aqi)
-    bp_low,bp_hi,i_low,i_hi = breakpoints[-1]
-    if concentration > bp_hi:
-        if(bp_hi - bp_low) == 0: return i_hi
-        aqi = ((i_hi - i_low) / (bp_hi - bp_low)) * (concentration - bp_low) + i_low
-        return round(aqi)
-    return 0
+    if pollutant_key not in BREAKPOINTS: return 0
+    breakpoints = BP_TABLE[POLLUTANT_KEYS.index(pollutant_key)]
+    # First band whose upper bound covers the concentration; the last band is extrapolated.
+    idx = min(np.searchsorted(breakpoints[:, 1], concentration), len(breakpoints) - 1)
+    bp_low, bp_hi, i_low, i_hi = breakpoints[idx]
+    return round((i_hi - i_low) / (bp_hi - bp_low) * (concentration - bp_low) + i_low)
+
+def calculate_all_aqis(concentrations):
+    """Computes the AQI of every pollutant in one pass. Takes concentrations in POLLUTANT_KEYS order and returns an int array in the same order."""
+    c = np.asarray(concentrations, dtype=np.float64)
+    # Batched searchsorted: count the bands whose upper bound lies below each concentration.
+    idx = np.minimum((BP_TABLE[:, :, 1] < c[:, None]).sum(axis=1), BP_TABLE.shape[1] - 1)
+    bp_low, bp_hi, i_low, i_hi = BP_TABLE[_BP_ROWS, idx].T
+    aqis = np.rint((i_hi - i_low) / (bp_hi - bp_low) * (c - bp_low) + i_low)
+    return np.where(c < 0, 0, aqis).astype(int)
 
 MW_O3, MW_CO, MW_SO2, MW_NO2 = 48.0, 28.01, 64.07, 46.01
 MOLAR_VOLUME = 24.45
+# μg/m³ -> breakpoint units, and the precision each pollutant is truncated to, in POLLUTANT_KEYS order.
+# Kept as numerator/denominator so the float operations run in the same order as (v * MOLAR_VOLUME) / (MW * 1000).
+CONV_NUM = np.array([MOLAR_VOLUME, 1.0, 1.0, MOLAR_VOLUME, MOLAR_VOLUME, MOLAR_VOLUME])
+CONV_DEN = np.array([MW_O3 * 1000, 1.0, 1.0, MW_CO * 1000, MW_SO2, MW_NO2])
+TRUNCATION_SCALES = np.array([1000.0, 10.0, 1.0, 10.0, 1.0, 1.0])
+# OpenWeather component names in POLLUTANT_KEYS order; missing components count as 0.
+COMPONENT_DEFAULTS = {'o3': 0, 'pm2_5': 0, 'pm10': 0, 'co': 0, 'so2': 0, 'no2': 0}
+_GET_COMPONENTS = itemgetter(*COMPONENT_DEFAULTS)
+METRIC_LABELS = ("O₃ (μg/m³)", "PM₂.₅ (μg/m³)", "PM₁₀ (μg/m³)", "CO (μg/m³)", "SO₂ (μg/m³)", "NO₂ (μg/m³)")
+
+HTTP_TIMEOUT = (2, 4)
+# Coordinates are snapped to 3 decimals (~110 m) so nearby clicks share a cache entry.
+# This bounds spatial resolution, but air quality data is effectively constant at that scale.
+GRID_DECIMALS = 3
+
+def _grid(x):
+    return round(x, GRID_DECIMALS)
+
+@st.cache_resource
+def get_http_session():
+    """Returns a pooled HTTP session shared across reruns and user sessions."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=Retry(total=2, backoff_factor=0.2))
+    session.mount("https://", adapter)
+    return session
+
 @st.cache_data(ttl=600)
-def fetch_air_quality_data(lat, lon, api_key):
-    air_quality_url = f"https://api.openweathermap.org/data/2.5/air_pollution?lat={lat}&lon={lon}&appid={api_key}&units=metric"
-    geocode_url = f"https://api.openweathermap.org/geo/1.0/reverse?lat={lat}&lon={lon}&limit=1&appid={api_key}"
+def fetch_air_quality_data(lat, lon):
+    air_quality_url = f"https://api.openweathermap.org/data/2.5/air_pollution?lat={lat}&lon={lon}&appid={OPENWEATHER_API_KEY}&units=metric"
+    geocode_url = f"https://api.openweathermap.org/geo/1.0/reverse?lat={lat}&lon={lon}&limit=1&appid={OPENWEATHER_API_KEY}"
     try:
-        air_res, geo_res = requests.get(air_quality_url), requests.get(geocode_url)
+        # Both calls are independent, so issue them concurrently and wait on the slower one.
+        session = get_http_session()
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            air_future = executor.submit(session.get, air_quality_url, timeout=HTTP_TIMEOUT)
+            geo_future = executor.submit(session.get, geocode_url, timeout=HTTP_TIMEOUT)
+            air_res, geo_res = air_future.result(), geo_future.result()
         air_res.raise_for_status(); geo_res.raise_for_status()
-        return air_res.json(), geo_res.json()
-    except requests.exceptions.RequestException as e:
+        return json_loads(air_res.content), json_loads(geo_res.content)
+    except (requests.exceptions.RequestException, ValueError) as e:
         st.error(f"Error fetching data: {e}"); return None, None
-def geocode_city(city_name, api_key):
-    geocode_url = f"https://api.openweathermap.org/geo/1.0/direct?q={city_name}&limit=1&appid={api_key}"
-    try:
-        response = requests.get(geocode_url); response.raise_for_status()
-        data = response.json()
-        if data: return data[0]['lat'], data[0]['lon']
-    except requests.exceptions.RequestException: return None, None
+# City coordinates are effectively static, so results persist on disk across restarts (persist ignores ttl).
+@st.cache_data(persist="disk", max_entries=512, show_spinner=False)
+def geocode_city(city_name):
+    """Returns (lat, lon) for a city, or None if not found. Callers should pass normalize_city_name() output to share
+    cache entries. Request errors propagate so that transient failures are not persisted."""
+    geocode_url = f"https://api.openweathermap.org/geo/1.0/direct?q={city_name}&limit=1&appid={OPENWEATHER_API_KEY}"
+    response = get_http_session().get(geocode_url, timeout=HTTP_TIMEOUT); response.raise_for_status()
+    data = json_loads(response.content)
+    return (data[0]['lat'], data[0]['lon']) if data else None
+
+def normalize_city_name(city_name):
+    return " ".join(city_name.split()).lower()
+
+def build_map(lat, lon, zoom, popup_text=None):
+    """Builds a fresh folium map each rerun; st_folium mutates the map while rendering, so it must not be shared."""
+    m = folium.Map(location=[lat, lon], zoom_start=zoom)
+    if popup_text:
+        folium.Marker(location=[lat, lon], popup=popup_text, tooltip="Current Location").add_to(m)
+    return m
+
+BANNER_TMPL = """
+        <div style="background-color: {color}; color: #000000; padding: 10px; border-radius: 8px; text-align: center; height: 100%;">
+            <div style="font-size: 1.1em; font-weight: bold;">{level} (AQI: {aqi})</div>
+            <p style="font-size: 0.9em; margin-top: 5px;">{description}</p>
+            <p style="font-size: 0.8em; margin-top: 8px; opacity: 0.8;"><em>From AirNow</em></p>
+        </div>
+        """
+LEVEL_CHIP_TMPL = """
+        <div style="display: flex; align-items: center; gap: 15px;">
+            <div style="width: 25px; height: 25px; background-color: {color}; border: 1px solid #888; border-radius: 50%;"></div>
+            <div><span style='font-size: 1.2em; font-weight: bold;'>{aqi}</span><span style='font-size: 1.1em;'> - {level}</span></div>
+        </div>"""
+
+def render_banner_html(level, color, description, aqi):
+    """HTML for the AirNow banner next to the search box."""
+    return BANNER_TMPL.format(level=level, color=color, description=description, aqi=aqi)
 
-if 'center' not in st.session_state: st.session_state['center'] = [-10.9472, -37.0731]
+def render_level_chip_html(level, color, aqi):
+    """HTML for the color swatch and AQI level shown in the analysis section."""
+    return LEVEL_CHIP_TMPL.format(level=level, color=color, aqi=aqi)
+
+if 'center' not in st.session_state: st.session_state['center'] = [_grid(-10.9472), _grid(-37.0731)]
 if 'zoom' not in st.session_state: st.session_state['zoom'] = 13
 
+def _on_search():
+    """Runs before the script body, so the new center is used on the same rerun as the click."""
+    search_query = st.session_state.get('search_query')
+    if search_query:
+        try: coords = geocode_city(normalize_city_name(search_query))
+        except (requests.exceptions.RequestException, ValueError): coords = None
+        if coords: st.session_state['center'] = [_grid(coords[0]), _grid(coords[1])]; st.session_state['zoom'] = 13
+        else: st.session_state['search_error'] = f"City '{search_query}' not found."
+
 st.title("Air Quality Monitor")
 top_cols = st.columns([2, 3])
 with top_cols[0]:
-    search_query = st.text_input("Search by city", placeholder="Enter a city name...")
-    if st.button("Search"):
-        if search_query:
-            lat, lon = geocode_city(search_query, OPENWEATHER_API_KEY)
-            if lat and lon: st.session_state['center'] = [lat, lon]; st.session_state['zoom'] = 13
-            else: st.error(f"City '{search_query}' not found.")
+    st.text_input("Search by city", placeholder="Enter a city name...", key='search_query')
+    st.button("Search", on_click=_on_search)
+    search_error = st.session_state.pop('search_error', None)
+    if search_error: st.error(search_error)
 
 current_lat, current_lon = st.session_state['center']
-air_data, geo_data = fetch_air_quality_data(current_lat, current_lon, OPENWEATHER_API_KEY)
+air_data, geo_data = fetch_air_quality_data(_grid(current_lat), _grid(current_lon))
 
-m = folium.Map(location=st.session_state['center'], zoom_start=st.session_state['zoom'])
+popup_text = None
 if air_data and geo_data:
-    components = air_data['list'][0]['components']
-    o3_v, pm25_v, pm10_v = components.get('o3',0), components.get('pm2_5',0), components.get('pm10',0)
-    co_v, so2_v, no2_v = components.get('co',0), components.get('so2',0), components.get('no2',0)
-    
-    o3_raw_ppm = (o3_v * MOLAR_VOLUME) / (MW_O3 * 1000)
-    co_raw_ppm = (co_v * MOLAR_VOLUME) / (MW_CO * 1000)
-    so2_raw_ppb = (so2_v * MOLAR_VOLUME) / MW_SO2
-    no2_raw_ppb = (no2_v * MOLAR_VOLUME) / MW_NO2
-
-    o3_c = int(o3_raw_ppm * 1000) / 1000.0
-    pm25_c = int(pm25_v * 10) / 10.0; pm10_c = int(pm10_v)
-    co_c = int(co_raw_ppm * 10) / 10.0
-    so2_c = int(so2_raw_ppb); no2_c = int(no2_raw_ppb)
-
-    aqi_v = {'o3_ppm':calculate_pollutant_aqi('o3_ppm',o3_c),'pm2_5':calculate_pollutant_aqi('pm2_5',pm25_c),
-             'pm10':calculate_pollutant_aqi('pm10',pm10_c),'co_ppm':calculate_pollutant_aqi('co_ppm',co_c),
-             'so2_ppb':calculate_pollutant_aqi('so2_ppb',so2_c),'no2_ppb':calculate_pollutant_aqi('no2_ppb',no2_c)}
-    overall_aqi = max(aqi_v.values()) if aqi_v else 0
+    components = {**COMPONENT_DEFAULTS, **air_data['list'][0]['components']}
+    raw = np.array(_GET_COMPONENTS(components), dtype=np.float64)
+    concentrations = np.floor(raw * CONV_NUM / CONV_DEN * TRUNCATION_SCALES) / TRUNCATION_SCALES
+    aqis = calculate_all_aqis(concentrations)
+    j = int(aqis.argmax())
+    overall_aqi, dominant_pollutant_key = int(aqis[j]), POLLUTANT_KEYS[j]
 
     location_name = geo_data[0].get('name', 'Unknown Location')
     airnow_info = get_airnow_aqi_info(overall_aqi)
     popup_text = f"<b>{location_name}</b><br>AQI: {overall_aqi} ({airnow_info['level']})"
     
     with top_cols[1]:
-        text_color = "#000000" if airnow_info['color'] == "#ffff00" else "#000000"
-        st.markdown(f"""
-        <div style="background-color: {airnow_info['color']}; color: {text_color}; padding: 10px; border-radius: 8px; text-align: center; height: 100%;">
-            <div style="font-size: 1.1em; font-weight: bold;">{airnow_info['level']} (AQI: {overall_aqi})</div>
-            <p style="font-size: 0.9em; margin-top: 5px;">{airnow_info['description']}</p>
-            <p style="font-size: 0.8em; margin-top: 8px; opacity: 0.8;"><em>From AirNow</em></p>
-        </div>
-        """, unsafe_allow_html=True)
-
-    folium.Marker(location=[current_lat, current_lon], popup=popup_text, tooltip="Current Location").add_to(m)
-
-map_data = st_folium(m, center=st.session_state['center'], zoom=st.session_state['zoom'], width='100%', height=400)
-if map_data and map_data['last_clicked']:
-    new_lat, new_lon = map_data['last_clicked']['lat'], map_data['last_clicked']['lng']
+        st.markdown(render_banner_html(airnow_info['level'], airnow_info['color'], airnow_info['description'], overall_aqi),
+                    unsafe_allow_html=True)
+
+m = build_map(current_lat, current_lon, st.session_state['zoom'], popup_text)
+map_data = st_folium(m, center=st.session_state['center'], zoom=st.session_state['zoom'], width='100%', height=400,
+                     returned_objects=["last_clicked"], key="aq_map")
+# With a stable key the component keeps returning its last click, so only handle clicks not seen before.
+if map_data and map_data['last_clicked'] and map_data['last_clicked'] != st.session_state.get('last_click'):
+    st.session_state['last_click'] = map_data['last_clicked']
+    new_lat, new_lon = _grid(map_data['last_clicked']['lat']), _grid(map_data['last_clicked']['lng'])
+    # Both sides are gridded, so a click that rounds onto the current center's cell does not trigger a rerun.
     if (new_lat, new_lon) != (current_lat, current_lon):
         st.session_state['center'] = [new_lat, new_lon]; st.rerun()
 
 if air_data and geo_data:
-    dominant_pollutant_key = max(aqi_v, key=aqi_v.get)
-    
     st.markdown("---")
     st.subheader(f"AQI Analysis for {location_name}")
     aqi_cols = st.columns(2)
     with aqi_cols[0]:
-        st.markdown(f"""
-        <div style="display: flex; align-items: center; gap: 15px;">
-            <div style="width: 25px; height: 25px; background-color: {airnow_info['color']}; border: 1px solid #888; border-radius: 50%;"></div>
-            <div><span style='font-size: 1.2em; font-weight: bold;'>{overall_aqi}</span><span style='font-size: 1.1em;'> - {airnow_info['level']}</span></div>
-        </div>""", unsafe_allow_html=True)
+        st.markdown(render_level_chip_html(airnow_info['level'], airnow_info['color'], overall_aqi), unsafe_allow_html=True)
     aqi_cols[1].metric("Dominant Pollutant", POLLUTANT_NAMES.get(dominant_pollutant_key, "N/A"))
 
-    with st.expander("See Concentrations"):
+    # A collapsed expander still builds and ships its contents, so only build the table when asked for.
+    if st.checkbox("See Concentrations", key='show_conc'):
         st.write("This table shows the original concentrations from the API (in μg/m³) and the resulting individual AQI calculated for each pollutant.")
         calc_details_cols = st.columns(6)
-        calc_details_cols[0].metric(label="O₃ (μg/m³)", value=f"{o3_v:.2f}", delta=f"AQI: {aqi_v['o3_ppm']}")
-        calc_details_cols[1].metric(label="PM₂.₅ (μg/m³)", value=f"{pm25_v:.2f}", delta=f"AQI: {aqi_v['pm2_5']}")
-        calc_details_cols[2].metric(label="PM₁₀ (μg/m³)", value=f"{pm10_v:.2f}", delta=f"AQI: {aqi_v['pm10']}")
-        calc_details_cols[3].metric(label="CO (μg/m³)", value=f"{co_v:.2f}", delta=f"AQI: {aqi_v['co_ppm']}")
-        calc_details_cols[4].metric(label="SO₂ (μg/m³)", value=f"{so2_v:.2f}", delta=f"AQI: {aqi_v['so2_ppb']}")
-        calc_details_cols[5].metric(label="NO₂ (μg/m³)", value=f"{no2_v:.2f}", delta=f"AQI: {aqi_v['no2_ppb']}")
+        for col, label, value, aqi in zip(calc_details_cols, METRIC_LABELS, raw, aqis):
+            col.metric(label=label, value=f"{value:.2f}", delta=f"AQI: {aqi}")
 else:
 
     st.warning("Waiting for a location to be selected on the map or searched to display data.")